@@ -1,20 +1,29 @@
 """API for Olympic Coast Treks."""
 
-import json
+import collections
+import functools
+import hashlib
+import threading
+import time
 from datetime import date, datetime
 from importlib.metadata import version
-from typing import Literal
+from typing import Callable, Literal, Optional
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, TypeAdapter
 
 from .data import LOCATIONS
 from .plot import plot_tides_and_restrictions
 from .process import calc_routes
+from .tides import call_tracking_tide_levels
 
 app = FastAPI(
-    title="Olympic Coast Treks API", version=version("olympic-coast-treks")
+    title="Olympic Coast Treks API",
+    version=version("olympic-coast-treks"),
+    default_response_class=ORJSONResponse,
 )
 app.add_middleware(
     CORSMiddleware,
@@ -28,6 +37,8 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Plot figures in particular are large and compress well
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
 
 
 class PlotlyFigureResponse(BaseModel):
@@ -47,15 +58,101 @@ class Route(BaseModel):
     last_possible_end: datetime
 
 
+_ROUTE_LIST_ADAPTER = TypeAdapter(list[Route])
+
+# Maximum number of results of each kind held in memory
+_MAX_CACHED_RESULTS = 512
+
+
+def _cache_while_tides_fresh(func: Callable) -> Callable:
+    """Cache the results of a function until its tide levels go out of date.
+
+    The wrapped function returns the result along with when it goes out of
+    date, as given by ``call_tracking_tide_levels``. Results using out of date
+    tide levels, because the NOAA API couldn't be reached, aren't cached.
+    """
+    cache = collections.OrderedDict()
+    lock = threading.Lock()
+
+    @functools.wraps(func)
+    def wrapper(*args) -> tuple:
+        with lock:
+            entry = cache.get(args)
+            if entry is not None:
+                cache.move_to_end(args)
+        if entry is not None and entry[1] > time.time():
+            return entry
+        entry = call_tracking_tide_levels(func, *args)
+        if entry[1] is not None:
+            with lock:
+                cache[args] = entry
+                cache.move_to_end(args)
+                if len(cache) > _MAX_CACHED_RESULTS:
+                    cache.popitem(last=False)
+        return entry
+
+    return wrapper
+
+
+# Results only depend on the query parameters and the tide levels, so
+# identical requests can be served from memory
+_calc_routes = _cache_while_tides_fresh(calc_routes)
+
+
+@_cache_while_tides_fresh
+def _plot_tides_and_restrictions(
+    start_location: str, end_location: str, start_time: datetime, speed: float
+) -> dict:
+    """Get the figure from ``plot_tides_and_restrictions`` as a dict."""
+    return plot_tides_and_restrictions(
+        start_location=start_location,
+        end_location=end_location,
+        start_time=start_time,
+        speed=speed,
+    ).to_plotly_json()
+
+
+def _calc_etag(*params) -> str:
+    """Calculate an ETag from the API version and the given parameters."""
+    digest = hashlib.blake2b(
+        repr((app.version, params)).encode(), digest_size=16
+    ).hexdigest()
+    return f'"{digest}"'
+
+
+def _is_not_modified(request: Request, etag: str) -> bool:
+    """Whether the client already has the response with the given ETag."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is None:
+        return False
+    return etag in [tag.strip() for tag in if_none_match.split(",")]
+
+
+def _cache_headers(
+    etag: str, tides_fresh_until: Optional[float]
+) -> dict[str, str]:
+    """HTTP headers allowing clients to cache a response.
+
+    Responses using out of date tide levels must be revalidated every time.
+    """
+    if tides_fresh_until is None:
+        return {"ETag": etag, "Cache-Control": "no-cache"}
+    return {"ETag": etag, "Cache-Control": "public, max-age=3600"}
+
+
 @app.get("/health")
 def get_health():
     return {"status": "healthy"}
 
 
-@app.get("/plot")
+@app.get("/plot", response_model=PlotlyFigureResponse)
 def get_plot(
-    start_location: str, end_location: str, start_time: datetime, speed: float
-) -> PlotlyFigureResponse:
+    start_location: str,
+    end_location: str,
+    start_time: datetime,
+    speed: float,
+    request: Request,
+) -> Response:
     """Get a plot of tides and restrictions given route information.
 
     Parameters
@@ -95,18 +192,28 @@ def get_plot(
             The last possible ending time within a given window.
     """
     try:
-        fig = plot_tides_and_restrictions(
-            start_location=start_location,
-            end_location=end_location,
-            start_time=start_time,
-            speed=speed,
+        figure, tides_fresh_until = _plot_tides_and_restrictions(
+            start_location, end_location, start_time, speed
         )
     except ValueError as e:
         raise HTTPException(400, str(e))
-    return json.loads(fig.to_json())
+    # Refreshed tide levels give a different ETag
+    etag = _calc_etag(
+        "plot",
+        start_location,
+        end_location,
+        start_time,
+        speed,
+        tides_fresh_until,
+    )
+    headers = _cache_headers(etag, tides_fresh_until)
+    if _is_not_modified(request, etag):
+        return Response(status_code=304, headers=headers)
+    # Serialize the figure directly rather than going through a JSON string
+    return ORJSONResponse(figure, headers=headers)
 
 
-@app.get("/routes")
+@app.get("/routes", response_model=list[Route])
 def get_routes(
     section: Literal["south", "middle", "north"],
     direction: Literal["north", "south"],
@@ -116,7 +223,9 @@ def get_routes(
     max_daily_distance: float = 10.0,
     speed: float = 1.0,
     min_buffer: float = 1.0,
-) -> list[Route]:
+    *,
+    request: Request,
+) -> Response:
     """Get possible routes.
 
     Parameters
@@ -169,20 +278,34 @@ def get_routes(
         * ``last_possible_end`` : datetime
             The last possible ending time within a given window.
     """
+    params = (
+        start_date,
+        end_date,
+        section,
+        direction,
+        min_daily_distance,
+        max_daily_distance,
+        speed,
+        min_buffer,
+    )
     try:
-        routes = calc_routes(
-            start_date=start_date,
-            end_date=end_date,
-            section=section,
-            direction=direction,
-            min_daily_distance=min_daily_distance,
-            max_daily_distance=max_daily_distance,
-            speed=speed,
-            min_buffer=min_buffer,
-        )
+        routes, tides_fresh_until = _calc_routes(*params)
     except ValueError as e:
         raise HTTPException(400, str(e))
-    return [Route(**r) for r in routes.to_dicts()]
+    # Refreshed tide levels give a different ETag
+    etag = _calc_etag("routes", *params, tides_fresh_until)
+    headers = _cache_headers(etag, tides_fresh_until)
+    if _is_not_modified(request, etag):
+        return Response(status_code=304, headers=headers)
+    # Validate and serialize in one go rather than having FastAPI validate the
+    # routes a second time
+    return Response(
+        _ROUTE_LIST_ADAPTER.dump_json(
+            _ROUTE_LIST_ADAPTER.validate_python(routes.to_dicts())
+        ),
+        media_type="application/json",
+        headers=headers,
+    )
 
 
 @app.get("/locations")
@@ -1,5 +1,7 @@
 """Static data necessary for calculations."""
 
+import polars as pl
+
 RESTRICTIONS = {}
 RESTRICTIONS["south"] = [
     {
@@ -362,3 +364,76 @@ LOCATIONS["north"] = [
         "trailhead": True,
     },
 ]
+
+# Distance in miles of the northernmost location of each section. Every
+# section starts at 0 miles, so this is also the length of the section.
+MAX_DISTANCES = {
+    section: max(location["distance_miles"] for location in locations)
+    for section, locations in LOCATIONS.items()
+}
+
+
+def _build_locations_df(section: str, direction: str) -> pl.DataFrame:
+    """Build the location frame for a section and direction of travel."""
+    locations = pl.DataFrame(LOCATIONS[section])
+    # Distances are given from south to north
+    # Reverse these if traveling north to south
+    if direction == "south":
+        locations = locations.reverse().with_columns(
+            (MAX_DISTANCES[section] - pl.col("distance_miles")).alias(
+                "distance_miles"
+            )
+        )
+    return locations.with_row_index("id")
+
+
+def _build_restrictions_df(section: str, direction: str) -> pl.DataFrame:
+    """Build the restriction frame for a section and direction of travel."""
+    restrictions = pl.DataFrame(RESTRICTIONS[section])
+    # Restrictions are given from south to north
+    # Reverse these if traveling north to south
+    if direction == "south":
+        restrictions = restrictions.select(
+            pl.exclude(["start_miles", "end_miles"]),
+            (MAX_DISTANCES[section] - pl.col("start_miles")).alias(
+                "end_miles"
+            ),
+            (MAX_DISTANCES[section] - pl.col("end_miles")).alias(
+                "start_miles"
+            ),
+        ).sort("start_miles")
+    return restrictions
+
+
+# There are only a handful of section and direction combinations, so build
+# the frames for all of them once up front
+LOCATIONS_DF = {
+    (section, direction): _build_locations_df(section, direction)
+    for section in LOCATIONS
+    for direction in ["north", "south"]
+}
+RESTRICTIONS_DF = {
+    (section, direction): _build_restrictions_df(section, direction)
+    for section in RESTRICTIONS
+    for direction in ["north", "south"]
+}
+
+# Row ID and distance of each location, by section and direction of travel
+LOCATION_INDEX = {
+    key: {
+        name: (idx, distance)
+        for idx, name, distance in locations.select(
+            "id", "name", "distance_miles"
+        ).iter_rows()
+    }
+    for key, locations in LOCATIONS_DF.items()
+}
+
+# Columns of each restriction frame as NumPy arrays
+RESTRICTION_ARRAYS = {
+    key: {
+        name: column.to_numpy()
+        for name, column in restrictions.to_dict().items()
+    }
+    for key, restrictions in RESTRICTIONS_DF.items()
+}
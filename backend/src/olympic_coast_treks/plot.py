@@ -1,5 +1,6 @@
 """Plotting functionality."""
 
+import math
 from datetime import datetime, timedelta
 
 import numpy as np
@@ -7,8 +8,43 @@ import plotly.graph_objects as go
 import polars as pl
 from plotly.subplots import make_subplots
 
-from .data import LOCATIONS
-from .process import get_locations, get_restrictions, get_tide_levels
+from .data import LOCATION_INDEX, LOCATIONS
+from .process import get_locations, get_restrictions
+from .tides import get_tide_levels_range
+
+# Sections containing each location name. Trailheads shared by adjacent
+# sections (e.g. Ozette Trailhead) map to more than one section.
+_LOCATION_SECTIONS = {
+    location["name"]: [
+        section
+        for section in LOCATIONS
+        if location["name"] in LOCATION_INDEX[(section, "north")]
+    ]
+    for locations in LOCATIONS.values()
+    for location in locations
+}
+# Layout shared by every figure, with the tide level on the primary y-axis
+# and the distance on the secondary y-axis. Only the axis ranges and the
+# location markers change between figures.
+_BASE_LAYOUT = {
+    key: value
+    for key, value in make_subplots(specs=[[{"secondary_y": True}]])
+    .update_xaxes(title="Level (feet)", ticklabelstandoff=10)
+    .update_yaxes(ticklabelposition="outside left", ticklabelstandoff=5)
+    .update_yaxes(title="Local time", secondary_y=False, showgrid=False)
+    .update_yaxes(
+        title="Distance (miles)",
+        secondary_y=True,
+        showgrid=False,
+        zeroline=False,
+        overlaying="y",
+    )
+    .update_layout(legend=dict(yanchor="bottom", y=1.02, xanchor="left", x=0))
+    .to_plotly_json()["layout"]
+    .items()
+    # The default template is applied when each figure is created
+    if key != "template"
+}
 
 
 def plot_tides_and_restrictions(
@@ -41,54 +77,35 @@ def plot_tides_and_restrictions(
         raise ValueError("The hiking speed must be a positive number")
     if start_location == end_location:
         raise ValueError("start and end locations must be different")
-    locations = pl.concat(
-        [
-            pl.DataFrame(value).with_columns(pl.lit(key).alias("section"))
-            for key, value in LOCATIONS.items()
-        ]
-    )
-    filtered_locations = locations.filter(
-        (pl.col("name") == start_location) | (pl.col("name") == end_location)
-    )
-    if len(filtered_locations) == 0:
+    start_sections = _LOCATION_SECTIONS.get(start_location)
+    end_sections = _LOCATION_SECTIONS.get(end_location)
+    if start_sections is None and end_sections is None:
         raise ValueError("Invalid start and end locations")
-    if len(filtered_locations.filter(pl.col("name") == start_location)) == 0:
+    if start_sections is None:
         raise ValueError("Invalid start location")
-    if len(filtered_locations.filter(pl.col("name") == end_location)) == 0:
+    if end_sections is None:
         raise ValueError("Invalid end location")
-    section = filtered_locations.select(
-        pl.col("section").mode().first()
-    ).item()
-    filtered_locations = filtered_locations.filter(
-        pl.col("section") == section
-    )
-    if len(filtered_locations) < 2:
+    sections = [s for s in start_sections if s in end_sections]
+    if not sections:
         raise ValueError(
             "The start location and end location must be in the same section"
         )
-    assert len(filtered_locations) == 2
-    if filtered_locations.item(0, "name") == start_location:
+    section = sections[0]
+    # Location IDs increase from south to north when traveling north
+    location_index = LOCATION_INDEX[(section, "north")]
+    if location_index[start_location][0] < location_index[end_location][0]:
         direction = "north"
     else:
         direction = "south"
-    locations = get_locations(section=section, direction=direction)
-    start_id = (
-        locations.filter(pl.col("name") == start_location).select("id").item()
-    )
-    end_id = (
-        locations.filter(pl.col("name") == end_location).select("id").item()
-    )
-    locations = locations.filter(pl.col("id").is_between(start_id, end_id))
-    first_distance = locations["distance_miles"].first()
-    last_distance = locations["distance_miles"].last()
-    locations = locations.with_columns(
-        timestamp=start_time
-        + pl.duration(
-            minutes=60 * (pl.col("distance_miles") - first_distance) / speed
-        )
+    location_index = LOCATION_INDEX[(section, direction)]
+    start_id, first_distance = location_index[start_location]
+    end_id, last_distance = location_index[end_location]
+    locations = get_locations(section=section, direction=direction).slice(
+        start_id, end_id - start_id + 1
     )
     restrictions = (
         get_restrictions(section=section, direction=direction)
+        .lazy()
         .filter(
             (pl.col("end_miles") >= first_distance)
             & (pl.col("start_miles") <= last_distance)
@@ -97,115 +114,127 @@ def plot_tides_and_restrictions(
             pl.col("start_miles").clip(lower_bound=first_distance),
             pl.col("end_miles").clip(upper_bound=last_distance),
         )
+        # Round to the microsecond like the travel times used for the routes,
+        # so both agree on which tide predictions are on a restriction
         .with_columns(
             start_time=start_time
             + pl.duration(
-                minutes=60 * (pl.col("start_miles") - first_distance) / speed
+                microseconds=(
+                    3.6e9 * (pl.col("start_miles") - first_distance) / speed
+                ).round()
             ),
             end_time=start_time
             + pl.duration(
-                minutes=60 * (pl.col("end_miles") - first_distance) / speed
+                microseconds=(
+                    3.6e9 * (pl.col("end_miles") - first_distance) / speed
+                ).round()
             ),
         )
+        .collect()
     )
     end_time = start_time + timedelta(
         hours=(last_distance - first_distance) / speed
     )
-    tides = []
-    for tide_day in pl.date_range(
-        start_time.date(), end_time.date(), "1d", eager=True
-    ).to_list():
-        tides.append(get_tide_levels(day=tide_day))
-    # Include adjacent values in case we don't line up perfectly
-    tides = pl.concat(tides).filter(
-        pl.col("timestamp").is_between(
-            start_time - timedelta(minutes=6),
-            end_time + timedelta(minutes=6),
-            closed="none",
+    tides = get_tide_levels_range(start=start_time, end=end_time)
+    xaxis_min, xaxis_max, restriction_above_tides = (
+        pl.concat(
+            [
+                tides.select(
+                    level_ft=pl.col("height_ft"), is_restriction=pl.lit(False)
+                ),
+                restrictions.select(
+                    level_ft=pl.col("restriction_ft").cast(pl.Float64),
+                    is_restriction=pl.lit(True),
+                ),
+            ]
         )
-    )
-    if restrictions.is_empty():
-        xaxis_min = tides["height_ft"].min()
-        xaxis_max = tides["height_ft"].max()
-    else:
-        xaxis_min = np.floor(
-            min(tides["height_ft"].min(), restrictions["restriction_ft"].min())
+        .select(
+            pl.col("level_ft").min().alias("min_ft"),
+            pl.col("level_ft").max().alias("max_ft"),
+            (
+                pl.col("level_ft").filter("is_restriction").max()
+                > pl.col("level_ft").filter(~pl.col("is_restriction")).max()
+            ).alias("restriction_above_tides"),
         )
-        # Need to give a little buffer to the restriction so it's visible
-        if tides["height_ft"].max() < restrictions["restriction_ft"].max():
-            xaxis_max = np.ceil(restrictions["restriction_ft"].max()) + 1
-        else:
-            xaxis_max = np.ceil(
-                max(
-                    tides["height_ft"].max(),
-                    restrictions["restriction_ft"].max(),
-                )
-            )
-    fig = make_subplots(specs=[[{"secondary_y": True}]])
-    fig.add_trace(
+        .row(0)
+    )
+    # The tide levels alone set the bounds if there are no restrictions
+    if not restrictions.is_empty():
+        xaxis_min = math.floor(xaxis_min)
+        xaxis_max = math.ceil(xaxis_max)
+    # Need to give a little buffer to the restriction so it's visible
+    if restriction_above_tides:
+        xaxis_max += 1
+    heights = tides["height_ft"].to_numpy()
+    timestamps = tides["timestamp"].to_numpy()
+    traces = [
         go.Scatter(
-            x=[xaxis_min] + tides["height_ft"].to_list() + 2 * [xaxis_min],
-            y=[tides["timestamp"].min()]
-            + tides["timestamp"].to_list()
-            + [tides["timestamp"].max(), tides["timestamp"].min()],
+            x=np.concatenate(([xaxis_min], heights, [xaxis_min, xaxis_min])),
+            y=np.concatenate(
+                ([timestamps[0]], timestamps, [timestamps[-1], timestamps[0]])
+            ),
             mode="lines",
             line_width=0,
             legendgroup="tides",
             name="Tide level",
             fill="toself",
+            xaxis="x",
+            yaxis="y",
         ),
-        secondary_y=False,
-    )
-    fig.add_trace(
         go.Scatter(
-            x=tides["height_ft"].to_list(),
+            x=heights,
             y=(
-                (tides["timestamp"] - start_time).dt.total_seconds()
+                (timestamps - np.datetime64(start_time))
+                / np.timedelta64(1, "h")
                 * speed
-                / 3600
-            ).to_list(),
+            ),
             showlegend=False,
             hoverinfo="skip",
             mode="lines",
             line_width=0,
+            xaxis="x",
+            yaxis="y2",
         ),
-        secondary_y=True,
-    )
-    # Give list of lists, showing when it starts and ends being dark
-    night_ranges = (
-        tides.with_row_index()
-        .with_columns(pl.col("is_light").rle_id().alias("group"))
-        .with_columns(
-            [
-                pl.col("index").first().over("group").alias("first_idx"),
-                pl.col("index").last().over("group").alias("last_idx"),
-            ]
-        )
-        .filter(
-            (pl.col("index") == pl.col("first_idx"))
-            | (pl.col("index") == pl.col("last_idx"))
+    ]
+    # Runs of darkness, giving the row indices where each starts and ends
+    edges = np.flatnonzero(
+        np.diff(
+            np.concatenate(([False], ~tides["is_light"].to_numpy(), [False]))
         )
-        .with_columns(
-            ~pl.col("is_light").shift(-1).alias("is_not_light_next"),
-            pl.col("timestamp").shift(-1).alias("next_timestamp"),
-        )
-        .filter(~pl.col("is_light") & pl.col("is_not_light_next"))
-        .select(pl.col("timestamp"), pl.col("next_timestamp"))
-        .to_numpy()
-        .tolist()
     )
-    idx = 0
+    night_starts = edges[0::2]
+    night_ends = edges[1::2] - 1
+    is_run = night_ends > night_starts
+    night_ranges = zip(
+        timestamps[night_starts[is_run]].tolist(),
+        timestamps[night_ends[is_run]].tolist(),
+    )
+    # Draw all shaded regions of a kind as a single trace, using ``None`` to
+    # separate the polygons
+    night_x = []
+    night_y = []
     for start_timestamp_night, end_timestamp_night in night_ranges:
-        fig.add_trace(
+        night_x += [
+            xaxis_min,
+            xaxis_min,
+            xaxis_max,
+            xaxis_max,
+            xaxis_min,
+            None,
+        ]
+        night_y += [
+            start_timestamp_night,
+            end_timestamp_night,
+            end_timestamp_night,
+            start_timestamp_night,
+            start_timestamp_night,
+            None,
+        ]
+    if night_x:
+        traces.append(
             go.Scatter(
-                x=[xaxis_min, xaxis_min, xaxis_max, xaxis_max, xaxis_min],
-                y=[
-                    start_timestamp_night,
-                    end_timestamp_night,
-                    end_timestamp_night,
-                    start_timestamp_night,
-                    start_timestamp_night,
-                ],
+                x=night_x[:-1],
+                y=night_y[:-1],
                 fill="toself",
                 mode="lines",
                 line_width=0,
@@ -215,123 +244,111 @@ def plot_tides_and_restrictions(
                 hovertemplate="",
                 hoverinfo="name",
                 hoverlabel_namelength=-1,
-                showlegend=True if idx == 0 else False,
+                showlegend=True,
             )
         )
-        idx += 1
-    first_with_alternative = True
-    first_without_alternative = True
-    for row in restrictions.iter_rows(named=True):
-        if first_with_alternative and row["headland_alternative"]:
-            show_legend = True
-        elif first_without_alternative and not row["headland_alternative"]:
-            show_legend = True
-        else:
-            show_legend = False
-        if not row["headland_alternative"]:
+    for (headland_alternative,), group in restrictions.partition_by(
+        "headland_alternative", as_dict=True
+    ).items():
+        restriction_x = []
+        restriction_y = []
+        for restriction_ft, start, end in zip(
+            group["restriction_ft"].to_list(),
+            group["start_time"].to_list(),
+            group["end_time"].to_list(),
+        ):
+            restriction_x += [
+                restriction_ft,
+                restriction_ft,
+                xaxis_max,
+                xaxis_max,
+                None,
+            ]
+            restriction_y += [start, end, end, start, None]
+        if not headland_alternative:
             name = (
                 "Tide must be below this level. "
                 "No alternative route available."
             )
         else:
             name = "Use inland alternative when tide is above this level."
-
-        fig.add_trace(
+        traces.append(
             go.Scatter(
-                x=[row["restriction_ft"]] * 2 + [xaxis_max, xaxis_max],
-                y=[
-                    row["start_time"],
-                    row["end_time"],
-                    row["end_time"],
-                    row["start_time"],
-                ],
+                x=restriction_x[:-1],
+                y=restriction_y[:-1],
                 mode="lines",
                 line_width=0,
-                line_color=(
-                    "#00CC96" if row["headland_alternative"] else "#EF553B"
-                ),
-                legendgroup=f"restrictions-{row['headland_alternative']}",
+                line_color="#00CC96" if headland_alternative else "#EF553B",
+                legendgroup=f"restrictions-{headland_alternative}",
                 name=name,
                 fill="toself",
-                showlegend=show_legend,
+                showlegend=True,
                 fillpattern=dict(
-                    shape="/" if row["headland_alternative"] else "x",
+                    shape="/" if headland_alternative else "x",
                     fillmode="overlay",
                 ),
                 hovertemplate="",
                 hoverinfo="name",
                 hoverlabel_namelength=-1,
-            ),
-            secondary_y=False,
-        )
-        if row["headland_alternative"]:
-            first_with_alternative = False
-        if not row["headland_alternative"]:
-            first_without_alternative = False
-    idx = 0
-    ozette_idx = 0
-    for location in locations.iter_rows(named=True):
-        if idx == 0:
-            if direction == "north":
-                annotation_position = "top left"
-            else:
-                annotation_position = "bottom left"
-        else:
-            if direction == "north":
-                annotation_position = (
-                    "top left" if idx % 2 == 0 else "bottom left"
-                )
-            else:
-                annotation_position = (
-                    "bottom left" if idx % 2 == 0 else "top left"
-                )
-        fig.add_hline(
-            y=location["distance_miles"] - first_distance,
-            line_dash="dot",
-            annotation_text=location["name"]
-            + ("*" if "Ozette River" in location["name"] else ""),
-            yref="y2",
-            annotation_position=annotation_position,
+                xaxis="x",
+                yaxis="y",
+            )
         )
-        if "Ozette River" in location["name"] and ozette_idx == 0:
-            fig.update_layout(meta={"ozette_river_warning": True})
-            ozette_idx += 1
-        idx += 1
-    fig.update_yaxes(
-        title="Local time",
-        secondary_y=False,
-        showgrid=False,
-    )
-    fig.update_yaxes(
-        title="Distance (miles)",
-        secondary_y=True,
-        showgrid=False,
-        zeroline=False,
-        overlaying="y",
-    )
-    fig.update_xaxes(
-        title="Level (feet)",
-        range=[xaxis_min, xaxis_max],
-        ticklabelstandoff=10,
-    )
-    fig.update_layout(
-        legend=dict(yanchor="bottom", y=1.02, xanchor="left", x=0)
-    )
-    fig.update_yaxes(
-        range=(
-            [start_time, end_time]
-            if direction == "north"
-            else [end_time, start_time]
-        ),
-        ticklabelposition="outside left",
-        ticklabelstandoff=5,
-    )
-    fig.update_yaxes(
-        range=(
-            [0, last_distance - first_distance]
-            if direction == "north"
-            else [last_distance - first_distance, 0]
-        ),
-        secondary_y=True,
-    )
-    return fig
+    distances = (locations["distance_miles"] - first_distance).to_list()
+    names = locations["name"].to_list()
+    # Alternate labels above and below the lines so they don't overlap
+    label_anchors = [
+        "bottom" if (idx % 2 == 0) == (direction == "north") else "top"
+        for idx in range(len(names))
+    ]
+    layout = {
+        **_BASE_LAYOUT,
+        "xaxis": {**_BASE_LAYOUT["xaxis"], "range": [xaxis_min, xaxis_max]},
+        "yaxis": {
+            **_BASE_LAYOUT["yaxis"],
+            "range": (
+                [start_time, end_time]
+                if direction == "north"
+                else [end_time, start_time]
+            ),
+        },
+        "yaxis2": {
+            **_BASE_LAYOUT["yaxis2"],
+            "range": (
+                [0, last_distance - first_distance]
+                if direction == "north"
+                else [last_distance - first_distance, 0]
+            ),
+        },
+        "shapes": [
+            dict(
+                type="line",
+                line_dash="dot",
+                xref="x domain",
+                x0=0,
+                x1=1,
+                yref="y2",
+                y0=distance,
+                y1=distance,
+            )
+            for distance in distances
+        ],
+        "annotations": [
+            dict(
+                text=name + ("*" if "Ozette River" in name else ""),
+                showarrow=False,
+                xref="x domain",
+                x=0,
+                xanchor="left",
+                yref="y2",
+                y=distance,
+                yanchor=label_anchor,
+            )
+            for name, distance, label_anchor in zip(
+                names, distances, label_anchors
+            )
+        ],
+    }
+    if any("Ozette River" in name for name in names):
+        layout["meta"] = {"ozette_river_warning": True}
+    return go.Figure(data=traces, layout=layout)
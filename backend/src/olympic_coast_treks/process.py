@@ -1,13 +1,27 @@
 """Code for processing routes."""
 
-import itertools
+import functools
 from datetime import date, datetime, timedelta
-from typing import Literal
+from typing import Literal, Optional
 
+import numpy as np
 import polars as pl
+from numpy.lib.stride_tricks import sliding_window_view
 
-from .data import LOCATIONS, RESTRICTIONS
-from .tides import get_tide_levels
+from .data import (
+    LOCATION_INDEX,
+    LOCATIONS,
+    LOCATIONS_DF,
+    MAX_DISTANCES,
+    RESTRICTION_ARRAYS,
+    RESTRICTIONS,
+    RESTRICTIONS_DF,
+)
+from .tides import (
+    get_light_tide_levels,
+    prefetch_tide_levels,
+    read_light_tide_levels,
+)
 
 
 def calc_routes(
@@ -83,15 +97,12 @@ def calc_routes(
         raise ValueError("``direction`` must be either 'north' or 'south'")
     if end_date <= start_date:
         raise ValueError("``end_date`` must be after ``start_date``")
-    locations = get_locations(section=section, direction=direction)
-    restrictions = get_restrictions(section=section, direction=direction)
-    nights = (end_date - start_date).days
-    campsite_lists = calc_possible_campsites(
-        locations=locations,
-        nights=nights,
+    _validate_daily_distances(
         min_daily_distance=min_daily_distance,
         max_daily_distance=max_daily_distance,
     )
+    locations = get_locations(section=section, direction=direction)
+    nights = (end_date - start_date).days
     empty_res = pl.DataFrame(
         [],
         schema={
@@ -106,9 +117,25 @@ def calc_routes(
             "last_possible_end": datetime,
         },
     )
+    # Each day covers a leg between consecutive stops, so the legs must add up
+    # to the length of the section
+    legs = nights + 1
+    if not (
+        legs * min_daily_distance
+        <= MAX_DISTANCES[section]
+        <= legs * max_daily_distance
+    ):
+        return empty_res
+    campsite_lists = calc_possible_campsites(
+        locations=locations,
+        nights=nights,
+        min_daily_distance=min_daily_distance,
+        max_daily_distance=max_daily_distance,
+    )
     if not campsite_lists:
         return empty_res
-    valid_schedules = []
+    tides_fresh_until = prefetch_tide_levels(start=start_date, end=end_date)
+    rows = []
     for campsite_list_index, campsite_list in enumerate(campsite_lists):
         stops = (
             [locations["name"][0]]
@@ -120,42 +147,55 @@ def calc_routes(
             start_location = stops[idx]
             end_location = stops[idx + 1]
             day = start_date + timedelta(days=idx)
-            res = analyze_route_on_day(
+            # Legs using out of date tide levels, because NOAA couldn't be
+            # reached, aren't cached so they are analyzed again next time
+            if tides_fresh_until[day] is None:
+                analyze = _analyze_route_on_day_rows
+            else:
+                analyze = _analyze_route_on_day_cached
+            res = analyze(
+                section=section,
+                direction=direction,
                 start_location=start_location,
                 end_location=end_location,
                 day=day,
-                locations=locations,
-                restrictions=restrictions,
+                tides_fresh_until=tides_fresh_until[day],
                 speed=speed,
                 min_buffer=min_buffer,
             )
-            if res.is_empty():
+            if not res:
                 break
-            schedules_per_day.append(res)
-        if len(schedules_per_day) == len(stops) - 1:
-            valid_schedules.append(
-                pl.concat(schedules_per_day).with_columns(
-                    pl.lit(campsite_list_index).alias("campsite_combination"),
-                )
-            )
-    if valid_schedules:
-        sort_columns = ["campsite_combination", "date"]
-        return (
-            pl.concat(valid_schedules)
-            .sort(*sort_columns)
-            .select(
-                [
-                    *sort_columns,
-                    "start_location",
-                    "end_location",
-                    pl.all().exclude(
-                        sort_columns + ["start_location", "end_location"]
-                    ),
-                ]
+            schedules_per_day.extend(res)
+        else:
+            rows.extend(
+                (campsite_list_index, *row) for row in schedules_per_day
             )
-        )
-    else:
+    if not rows:
         return empty_res
+    # Rows are already ordered by campsite combination and date
+    return pl.DataFrame(
+        rows,
+        schema={
+            "campsite_combination": pl.Int32,
+            "first_possible_start": pl.Datetime("us"),
+            "last_possible_start": pl.Datetime("us"),
+            "first_possible_end": pl.Datetime("us"),
+            "last_possible_end": pl.Datetime("us"),
+            "start_location": pl.String,
+            "end_location": pl.String,
+            "distance": pl.Float64,
+            "date": pl.Date,
+        },
+        orient="row",
+    ).select(
+        "campsite_combination",
+        "date",
+        "start_location",
+        "end_location",
+        pl.exclude(
+            "campsite_combination", "date", "start_location", "end_location"
+        ),
+    )
 
 
 def analyze_route_on_day(
@@ -203,81 +243,73 @@ def analyze_route_on_day(
         date are also included as the ``start_location``, ``end_location``,
         ``distance``, and ``date`` columns, respectively.
     """
+    distances = dict(
+        zip(locations["name"].to_list(), locations["distance_miles"].to_list())
+    )
+    return _analyze_leg(
+        start_location=start_location,
+        end_location=end_location,
+        first_distance=distances[start_location],
+        last_distance=distances[end_location],
+        day=day,
+        tides=get_light_tide_levels(day=day),
+        restrictions={
+            name: column.to_numpy()
+            for name, column in restrictions.sort("start_miles")
+            .to_dict()
+            .items()
+        },
+        speed=speed,
+        min_buffer=min_buffer,
+    )
+
+
+def _analyze_leg(
+    start_location: str,
+    end_location: str,
+    first_distance: float,
+    last_distance: float,
+    day: date,
+    tides: pl.DataFrame,
+    restrictions: dict[str, np.ndarray],
+    speed: float,
+    min_buffer: float,
+) -> pl.DataFrame:
+    """Analyze a route given its distances, tides and restriction columns.
+
+    The tides are those from ``get_light_tide_levels`` for ``day``, and the
+    restrictions must be sorted by ``start_miles``.
+
+    See ``analyze_route_on_day`` for details.
+    """
     if speed <= 0:
         raise ValueError("The hiking speed must be a positive number")
     if min_buffer < 0:
         raise ValueError("The minimum buffer cannot be negative")
-    tides = get_tide_levels(day=day).filter(pl.col("is_light"))
-    start_id = (
-        locations.filter(pl.col("name") == start_location).select("id").item()
-    )
-    end_id = (
-        locations.filter(pl.col("name") == end_location).select("id").item()
+    timestamps = tides["timestamp"].to_numpy()
+    heights = tides["height_ft"].to_numpy()
+    # Restrictions are sorted by where they start, so only the ones up to
+    # the end of the leg can be along it
+    candidates = slice(
+        0,
+        np.searchsorted(
+            restrictions["start_miles"], last_distance, side="right"
+        ),
     )
-    locations = locations.filter(pl.col("id").is_between(start_id, end_id))
-    first_distance = locations["distance_miles"].first()
-    last_distance = locations["distance_miles"].last()
-    restrictions = restrictions.filter(
-        (pl.col("end_miles") >= first_distance)
-        & (pl.col("start_miles") <= last_distance)
-    ).with_columns(
-        start_travel_time_hr=(pl.col("start_miles") - first_distance) / speed,
-        end_travel_time_hr=(pl.col("end_miles") - first_distance) / speed,
-    )
-    possible_times = []
-    for start_time in tides["timestamp"]:
-        end_time = start_time + timedelta(
-            hours=(last_distance - first_distance) / speed
-        )
-        if end_time > tides["timestamp"].last():
-            continue
-        daily_tides = tides.filter(
-            tides["timestamp"].is_between(start_time, end_time)
-        ).with_columns(
-            travel_time_hr=(
-                pl.col("timestamp") - start_time
-            ).dt.total_minutes()
-            / 60.0
-        )
-        tides_and_restrictions = (
-            daily_tides.lazy()
-            .join(restrictions.lazy(), how="cross")
-            .filter(
-                pl.col("travel_time_hr").is_between(
-                    pl.col("start_travel_time_hr"),
-                    pl.col("end_travel_time_hr"),
-                )
-            )
-            .group_by("travel_time_hr", maintain_order=True)
-            .agg(
-                pl.col("restriction_ft").min(),
-                pl.col("headland_alternative").all(),
-                pl.col("height_ft").max(),
-            )
-            .select(
-                [
-                    "travel_time_hr",
-                    "restriction_ft",
-                    "headland_alternative",
-                    "height_ft",
-                ]
-            )
-            .collect()
-        )
-        tides_and_restrictions = tides_and_restrictions.with_columns(
-            (
-                (pl.col("height_ft") + min_buffer < pl.col("restriction_ft"))
-                | pl.col("headland_alternative")
-            ).alias("passable")
-        )
-        possible_times.append(
-            {
-                "start_time": start_time,
-                "end_time": end_time,
-                "passable": tides_and_restrictions["passable"].all(),
-            }
-        )
-    if not possible_times:
+    on_route = restrictions["end_miles"][candidates] >= first_distance
+    start_miles = restrictions["start_miles"][candidates][on_route]
+    end_miles = restrictions["end_miles"][candidates][on_route]
+    start_travel_times = _travel_hours(start_miles - first_distance, speed)
+    end_travel_times = _travel_hours(end_miles - first_distance, speed)
+    restriction_fts = restrictions["restriction_ft"][candidates][on_route]
+    headland_alternatives = restrictions["headland_alternative"][candidates][
+        on_route
+    ]
+    travel_hours = (last_distance - first_distance) / speed
+    end_times = timestamps + np.timedelta64(timedelta(hours=travel_hours))
+    # Only consider start times where the hike finishes within the day
+    valid = end_times <= timestamps[-1:]
+    if not valid.any():
         return pl.DataFrame(
             [],
             schema={
@@ -291,25 +323,238 @@ def analyze_route_on_day(
                 "date": date,
             },
         )
-    possible_times = (
-        pl.DataFrame(possible_times)
-        .sort("start_time")
-        .with_columns(pl.col("passable").rle_id().alias("run_id"))
-        .filter(pl.col("passable"))
+    start_times = timestamps[valid]
+    end_times = end_times[valid]
+    spacings = np.diff(timestamps)
+    # Predictions are normally evenly spaced, so the travel time to the n-th
+    # prediction after a start time is the same for every start time
+    is_regular = len(spacings) > 0 and (spacings == spacings[0]).all()
+    if (
+        headland_alternatives.all()
+        or heights.max() + min_buffer < restriction_fts.min()
+    ):
+        # The tide is always below every restriction, or they can all be
+        # bypassed
+        passable = np.ones(len(start_times), dtype=bool)
+    elif is_regular and _is_always_blocked(
+        spacings[0] / np.timedelta64(1, "h"),
+        heights,
+        travel_hours,
+        start_travel_times,
+        end_travel_times,
+        restriction_fts,
+        headland_alternatives,
+        min_buffer,
+    ):
+        passable = np.zeros(len(start_times), dtype=bool)
+    elif is_regular:
+        offsets = spacings[0] * np.arange(
+            (end_times[0] - start_times[0]) // spacings[0] + 1
+        )
+        limits = _restriction_limits(
+            offsets // np.timedelta64(1, "m") / 60.0,
+            start_travel_times,
+            end_travel_times,
+            restriction_fts,
+            headland_alternatives,
+        )
+        # Tide levels from each start time (rows) while hiking (columns)
+        windows = sliding_window_view(heights, len(offsets))[
+            : len(start_times)
+        ]
+        passable = (windows + min_buffer < limits).all(axis=1)
+    else:
+        # Travel time from each start time (rows) to each tide prediction
+        # (columns), only considering predictions while hiking
+        in_window = (timestamps[None, :] >= start_times[:, None]) & (
+            timestamps[None, :] <= end_times[:, None]
+        )
+        travel_times = (
+            (timestamps[None, :] - start_times[:, None])
+            // np.timedelta64(1, "m")
+            / 60.0
+        )
+        limits = _restriction_limits(
+            travel_times,
+            start_travel_times,
+            end_travel_times,
+            restriction_fts,
+            headland_alternatives,
+        )
+        passable = ((heights + min_buffer < limits) | ~in_window).all(axis=1)
+    # First and last start time of each run of passable start times
+    edges = np.diff(np.concatenate(([0], passable.view(np.int8), [0])))
+    first_idx = np.flatnonzero(edges == 1)
+    last_idx = np.flatnonzero(edges == -1) - 1
+    return pl.DataFrame(
+        {
+            "first_possible_start": start_times[first_idx],
+            "last_possible_start": start_times[last_idx],
+            "first_possible_end": end_times[first_idx],
+            "last_possible_end": end_times[last_idx],
+            "start_location": [start_location] * len(first_idx),
+            "end_location": [end_location] * len(first_idx),
+            "distance": [last_distance - first_distance] * len(first_idx),
+            "date": start_times[first_idx].astype("datetime64[D]"),
+        },
+        schema={
+            "first_possible_start": pl.Datetime("us"),
+            "last_possible_start": pl.Datetime("us"),
+            "first_possible_end": pl.Datetime("us"),
+            "last_possible_end": pl.Datetime("us"),
+            "start_location": pl.String,
+            "end_location": pl.String,
+            "distance": pl.Float64,
+            "date": pl.Date,
+        },
+    )
+
+
+def _analyze_route_on_day_rows(
+    section: Literal["south", "middle", "north"],
+    direction: Literal["north", "south"],
+    start_location: str,
+    end_location: str,
+    day: date,
+    tides_fresh_until: Optional[float],
+    speed: float,
+    min_buffer: float,
+) -> tuple[tuple, ...]:
+    """Get the rows of ``analyze_route_on_day`` for a section.
+
+    ``tides_fresh_until`` is when the cached tide levels on ``day`` go out of
+    date, as returned by ``prefetch_tide_levels``.
+    """
+    first_distance = LOCATION_INDEX[(section, direction)][start_location][1]
+    last_distance = LOCATION_INDEX[(section, direction)][end_location][1]
+    return tuple(
+        _analyze_leg(
+            start_location=start_location,
+            end_location=end_location,
+            first_distance=first_distance,
+            last_distance=last_distance,
+            day=day,
+            tides=read_light_tide_levels(day, tides_fresh_until),
+            restrictions=RESTRICTION_ARRAYS[(section, direction)],
+            speed=speed,
+            min_buffer=min_buffer,
+        ).rows()
+    )
+
+
+# Legs are shared by many campsite combinations and requests. When the tide
+# levels go out of date is part of the key, so legs are analyzed again once
+# the tide levels are refreshed.
+_analyze_route_on_day_cached = functools.lru_cache(maxsize=4096)(
+    _analyze_route_on_day_rows
+)
+
+
+def _travel_hours(distances: np.ndarray, speed: float) -> np.ndarray:
+    """Calculate the travel times (in hours) to cover some distances.
+
+    Travel times are rounded to the microsecond, like the tide timestamps. A
+    tide prediction exactly where a restriction starts or ends is then on the
+    restriction despite floating point error in the distances.
+    """
+    return np.round(distances / speed * 3.6e9) / 3.6e9
+
+
+def _is_always_blocked(
+    spacing: float,
+    heights: np.ndarray,
+    travel_hours: float,
+    start_travel_times: np.ndarray,
+    end_travel_times: np.ndarray,
+    restriction_fts: np.ndarray,
+    headland_alternatives: np.ndarray,
+    min_buffer: float,
+) -> bool:
+    """Determine whether a restriction blocks every start time.
+
+    A restriction without an alternative blocks a start time if the tide
+    level is too high at a prediction while it is being traversed. When the
+    tide is too high all day, this is the case for every start time as long
+    as traversing it takes longer than the spacing between predictions.
+
+    Parameters
+    ----------
+    spacing : float
+        Time (in hours) between consecutive tide predictions, which must be
+        evenly spaced.
+    heights : ndarray
+        Tide level (in feet) of each tide prediction.
+    travel_hours : float
+        Total travel time (in hours).
+    start_travel_times : ndarray
+        Elapsed travel time (in hours) when each restriction is reached.
+    end_travel_times : ndarray
+        Elapsed travel time (in hours) when each restriction is left.
+    restriction_fts : ndarray
+        Tide level (in feet) of each restriction.
+    headland_alternatives : ndarray
+        Whether each restriction has an inland alternative.
+    min_buffer : float
+        The minimum allowable buffer in feet between the tidal restriction and
+        the tide level.
+
+    Returns
+    -------
+    bool
+        Whether no start time is passable.
+    """
+    traverse_times = np.minimum(end_travel_times, travel_hours) - np.maximum(
+        start_travel_times, 0
     )
-    res = possible_times.group_by("run_id").agg(
-        pl.col("start_time").min().alias("first_possible_start"),
-        pl.col("start_time").max().alias("last_possible_start"),
-        pl.col("end_time").min().alias("first_possible_end"),
-        pl.col("end_time").max().alias("last_possible_end"),
+    return bool(
+        (
+            ~headland_alternatives
+            & (restriction_fts <= heights.min() + min_buffer)
+            # Allow for rounding in the travel times
+            & (traverse_times > spacing + 1e-6)
+        ).any()
+    )
+
+
+def _restriction_limits(
+    travel_times: np.ndarray,
+    start_travel_times: np.ndarray,
+    end_travel_times: np.ndarray,
+    restriction_fts: np.ndarray,
+    headland_alternatives: np.ndarray,
+) -> np.ndarray:
+    """Calculate the tide level limiting travel at each travel time.
+
+    Parameters
+    ----------
+    travel_times : ndarray
+        Elapsed travel times (in hours). May have any shape.
+    start_travel_times : ndarray
+        Elapsed travel time (in hours) when each restriction is reached.
+    end_travel_times : ndarray
+        Elapsed travel time (in hours) when each restriction is left.
+    restriction_fts : ndarray
+        Tide level (in feet) of each restriction.
+    headland_alternatives : ndarray
+        Whether each restriction has an inland alternative.
+
+    Returns
+    -------
+    ndarray
+        Array with the same shape as ``travel_times``. The tide level (in
+        feet) must be below this value to continue, or infinite if no
+        restriction without an alternative is being traversed.
+    """
+    # Restrictions being traversed at each travel time
+    active = (travel_times[..., None] >= start_travel_times) & (
+        travel_times[..., None] <= end_travel_times
+    )
+    limits = np.where(active, restriction_fts, np.inf).min(
+        axis=-1, initial=np.inf
+    )
+    return np.where(
+        (headland_alternatives | ~active).all(axis=-1), np.inf, limits
     )
-    res = res.with_columns(
-        pl.lit(start_location).alias("start_location"),
-        pl.lit(end_location).alias("end_location"),
-        pl.lit(last_distance - first_distance).alias("distance"),
-        pl.col("first_possible_start").dt.date().alias("date"),
-    ).drop("run_id")
-    return res
 
 
 def get_locations(
@@ -344,15 +589,7 @@ def get_locations(
         raise ValueError(f"``section`` must be in {list(LOCATIONS.keys())}")
     if direction not in ["south", "north"]:
         raise ValueError("``direction`` must be 'north' or 'south'")
-    locations = pl.DataFrame(LOCATIONS[section])
-    # Distances are given from south to north
-    # Reverse these if traveling north to south
-    if direction == "south":
-        locations = locations.reverse()
-        locations = locations.with_columns(
-            pl.col("distance_miles").max() - pl.col("distance_miles")
-        )
-    return locations.with_row_index("id")
+    return LOCATIONS_DF[(section, direction)]
 
 
 def get_restrictions(
@@ -391,19 +628,31 @@ def get_restrictions(
         raise ValueError(f"``section`` must be in {list(RESTRICTIONS.keys())}")
     if direction not in ["south", "north"]:
         raise ValueError("``direction`` must be 'north' or 'south'")
-    restrictions = pl.DataFrame(RESTRICTIONS[section])
-    # Restrictions are given from south to north
-    # Reverse these if traveling north to south
-    if direction == "south":
-        max_distance = get_locations(section=section, direction=direction)[
-            "distance_miles"
-        ].max()
-        restrictions = restrictions.select(
-            pl.exclude(["start_miles", "end_miles"]),
-            (max_distance - pl.col("start_miles")).alias("end_miles"),
-            (max_distance - pl.col("end_miles")).alias("start_miles"),
-        ).sort("start_miles")
-    return restrictions
+    return RESTRICTIONS_DF[(section, direction)]
+
+
+def _validate_daily_distances(
+    min_daily_distance: float, max_daily_distance: float
+) -> None:
+    """Validate the minimum and maximum daily distances.
+
+    Parameters
+    ----------
+    min_daily_distance : float
+        The minimum distance to travel in a day, in miles.
+    max_daily_distance : float
+        The maximum distance to travel in a day, in miles.
+    """
+    if min_daily_distance <= 0 or max_daily_distance <= 0:
+        raise ValueError(
+            "``min_daily_distance`` and ``max_daily_distance`` must both be "
+            "positive"
+        )
+    if min_daily_distance > max_daily_distance:
+        raise ValueError(
+            "``min_daily_distance`` must be greater than "
+            "``max_daily_distance``"
+        )
 
 
 def calc_possible_campsites(
@@ -432,32 +681,42 @@ def calc_possible_campsites(
     """
     if nights < 1:
         raise ValueError("``nights`` must be at least 1")
-    if min_daily_distance <= 0 or max_daily_distance <= 0:
-        raise ValueError(
-            "``min_daily_distance`` and ``max_daily_distance`` must both be "
-            "positive"
-        )
-    if min_daily_distance > max_daily_distance:
-        raise ValueError(
-            "``min_daily_distance`` must be greater than "
-            "``max_daily_distance``"
-        )
-    campsite_combinations = list(
-        itertools.combinations(
-            locations.filter(pl.col("campsite"))["name"], nights
-        )
+    _validate_daily_distances(
+        min_daily_distance=min_daily_distance,
+        max_daily_distance=max_daily_distance,
     )
-    valid_campsites = []
-    for campsites in campsite_combinations:
-        filter_locations = locations.filter(
-            pl.col("name").is_in(campsites) | pl.col("trailhead")
-        )
-        daily_distances = (
-            filter_locations["distance_miles"]
-            - filter_locations["distance_miles"].shift(1)
-        ).drop_nulls()
-        if daily_distances.is_between(
-            min_daily_distance, max_daily_distance
-        ).all():
-            valid_campsites.append(campsites)
-    return valid_campsites
+    stops = locations.filter(pl.col("campsite") | pl.col("trailhead"))
+    names = stops["name"].to_list()
+    distances = stops["distance_miles"].to_list()
+    campsites = stops["campsite"].to_list()
+    trailheads = stops["trailhead"].to_list()
+
+    def extend(idx: int, prev_distance: Optional[float], remaining: int):
+        """Yield the valid campsites at or after the stop at ``idx``."""
+        for next_idx in range(idx, len(names)):
+            # Only trailheads can be stopped at once all nights are used
+            if not trailheads[next_idx] and remaining == 0:
+                continue
+            if prev_distance is not None:
+                daily_distance = distances[next_idx] - prev_distance
+                # Stops are ordered by distance, so later ones are too far too
+                if daily_distance > max_daily_distance:
+                    return
+                if daily_distance < min_daily_distance:
+                    if trailheads[next_idx]:
+                        return
+                    continue
+            if campsites[next_idx] and remaining > 0:
+                for rest in extend(
+                    next_idx + 1, distances[next_idx], remaining - 1
+                ):
+                    yield (names[next_idx], *rest)
+            # Every trailhead is a stop, so later stops can't be reached
+            # without passing through it
+            if trailheads[next_idx]:
+                yield from extend(next_idx + 1, distances[next_idx], remaining)
+                return
+        if remaining == 0:
+            yield ()
+
+    return list(extend(0, None, nights))
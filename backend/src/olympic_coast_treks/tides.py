@@ -1,15 +1,23 @@
 """Functionality for fetching tide information."""
 
+import contextvars
+import functools
+import math
 import os
-from datetime import date
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from typing import Any, Callable, Optional
+from zoneinfo import ZoneInfo
 
 import diskcache
 import polars as pl
-import pytz
 import requests
 from astral import LocationInfo
 from astral.sun import sun
+from requests.adapters import HTTPAdapter
 from tenacity import (
+    RetryError,
     retry,
     retry_if_exception_type,
     stop_after_attempt,
@@ -20,18 +28,49 @@ tide_cache = diskcache.Cache(
     os.path.join(os.path.expanduser("~"), ".tide-cache")
 )
 
+_CITY = LocationInfo(
+    "La Push", "USA", "America/Los_Angeles", 47.9053, -124.626
+)
+_PACIFIC_TZ = ZoneInfo("America/Los_Angeles")
+
+# Maximum number of concurrent requests to the NOAA API
+_POOL_SIZE = 4
+# The NOAA API returns at most 31 days of 6-minute predictions per request
+_MAX_DAYS_PER_REQUEST = 31
+# Seconds to wait for the NOAA API to connect and to send data
+_REQUEST_TIMEOUT = 10
+# Errors from the NOAA API after which cached tide levels are used even if
+# they are out of date
+_FETCH_ERRORS = (requests.RequestException, RetryError, ValueError)
+
+# When the cached tide levels on each day go out of date, for the days this
+# process has used. Saves looking them up in ``tide_cache`` on every call.
+_fresh_until = {}
+
+# Earliest time the tide levels used in the current context go out of date, or
+# ``None`` if out of date tide levels were used
+_used_fresh_until = contextvars.ContextVar(
+    "_used_fresh_until", default=math.inf
+)
+
+# Reuse connections to the NOAA API across requests
+_session = requests.Session()
+_session.mount(
+    "https://",
+    HTTPAdapter(pool_connections=_POOL_SIZE, pool_maxsize=_POOL_SIZE),
+)
+
 
 def is_light(ts: pl.Series) -> pl.Series:
     """Is it light outside during the input timestamps?
 
-    Here, light is defined as being between sunrise and sunset. For efficiency,
-    it is required that the input data all is on the same day.
+    Here, light is defined as being between sunrise and sunset. The sunrise and
+    sunset times are only calculated once for each day in the input data.
 
     Parameters
     ----------
     ts : Series
-        Polars Series of timestamps in local (Pacific) time. All timestamps are
-        expected to fall on the same day.
+        Polars Series of timestamps in local (Pacific) time.
 
     Returns
     -------
@@ -41,18 +80,38 @@ def is_light(ts: pl.Series) -> pl.Series:
     """
     if ts.is_empty():
         return pl.Series("is_light", [], dtype=pl.Boolean)
-    if ts.min().date() != ts.max().date():
-        raise ValueError("All timestamps in ``ts`` should be on the same day")
-    city = LocationInfo(
-        "La Push", "USA", "America/Los_Angeles", 47.9053, -124.626
+    days = ts.dt.date()
+    sun_times = {day: get_daylight_bounds(day) for day in days.unique()}
+    sunrise = days.replace_strict(
+        {day: times[0] for day, times in sun_times.items()},
+        return_dtype=ts.dtype,
     )
-    pacific_tz = pytz.timezone("America/Los_Angeles")
-    s = sun(city.observer, date=ts.min().date(), tzinfo=pacific_tz)
-    sunrise, sunset = (
+    sunset = days.replace_strict(
+        {day: times[1] for day, times in sun_times.items()},
+        return_dtype=ts.dtype,
+    )
+    return ((ts >= sunrise) & (ts <= sunset)).alias("is_light")
+
+
+@functools.lru_cache(maxsize=512)
+def get_daylight_bounds(day: date) -> tuple[datetime, datetime]:
+    """Get the sunrise and sunset times on a given day.
+
+    Parameters
+    ----------
+    day : date
+        The day to consider.
+
+    Returns
+    -------
+    tuple[datetime, datetime]
+        The sunrise and sunset times in local (Pacific) time.
+    """
+    s = sun(_CITY.observer, date=day, tzinfo=_PACIFIC_TZ)
+    return (
         s["sunrise"].replace(tzinfo=None),
         s["sunset"].replace(tzinfo=None),
     )
-    return ((ts >= sunrise) & (ts <= sunset)).alias("is_light")
 
 
 @retry(
@@ -66,14 +125,13 @@ def is_light(ts: pl.Series) -> pl.Series:
         )
     ),
 )
-def _get_tides_from_api(day: date) -> requests.Response:
-    """Call the NOAA API to get tide data."""
-    str_date = day.strftime("%Y%m%d")
-    return requests.get(
+def _get_tides_from_api(begin: date, end: date) -> requests.Response:
+    """Call the NOAA API to get tide data between two days (inclusive)."""
+    return _session.get(
         "https://api.tidesandcurrents.noaa.gov/api/prod/datagetter",
         params=dict(
-            begin_date=str_date,
-            end_date=str_date,
+            begin_date=begin.strftime("%Y%m%d"),
+            end_date=end.strftime("%Y%m%d"),
             product="predictions",
             datum="MLLW",
             units="english",
@@ -82,10 +140,10 @@ def _get_tides_from_api(day: date) -> requests.Response:
             station="9442396",
             format="json",
         ),
+        timeout=_REQUEST_TIMEOUT,
     )
 
 
-@tide_cache.memoize(expire=86_400)
 def get_tide_levels(day: date) -> pl.DataFrame:
     """Get tide levels on a given data using the NOAA API.
 
@@ -107,7 +165,141 @@ def get_tide_levels(day: date) -> pl.DataFrame:
         * ``is_light``: bool
             Whether or not it is light outside at the specified time.
     """
-    tides_resp = _get_tides_from_api(day)
+    return _read_tide_levels(day, refresh_tide_levels(day))
+
+
+def get_light_tide_levels(day: date) -> pl.DataFrame:
+    """Get tide levels on a given day while it is light outside.
+
+    Parameters
+    ----------
+    day : date
+        The day to consider.
+
+    Returns
+    -------
+    DataFrame
+        Polars DataFrame with the ``timestamp`` and ``height_ft`` columns from
+        ``get_tide_levels``, only including the rows between sunrise and
+        sunset.
+    """
+    return read_light_tide_levels(day, refresh_tide_levels(day))
+
+
+def read_light_tide_levels(
+    day: date, fresh_until: Optional[float]
+) -> pl.DataFrame:
+    """Get cached tide levels on a given day while it is light outside.
+
+    Unlike ``get_light_tide_levels``, the tide levels are never fetched again.
+
+    Parameters
+    ----------
+    day : date
+        The day to consider. Its tide levels must already be cached.
+    fresh_until : float or None
+        When the cached tide levels go out of date, as returned by
+        ``refresh_tide_levels`` or ``prefetch_tide_levels``.
+
+    Returns
+    -------
+    DataFrame
+        Polars DataFrame with the same columns as ``get_light_tide_levels``.
+    """
+    tides = _read_tide_levels(day, fresh_until)
+    sunrise, sunset = get_daylight_bounds(day)
+    # Timestamps are sorted, so daylight is a single slice of the rows
+    first = tides["timestamp"].search_sorted(sunrise, side="left")
+    last = tides["timestamp"].search_sorted(sunset, side="right")
+    return tides.select("timestamp", "height_ft").slice(first, last - first)
+
+
+def refresh_tide_levels(day: date) -> Optional[float]:
+    """Fetch the tide levels on a given day unless they are up to date.
+
+    Parameters
+    ----------
+    day : date
+        The day to consider.
+
+    Returns
+    -------
+    float or None
+        When the cached tide levels go out of date, as a Unix timestamp.
+        ``None`` if they are out of date and the NOAA API couldn't be reached,
+        in which case the out of date levels are used.
+    """
+    return prefetch_tide_levels(start=day, end=day)[day]
+
+
+def _read_tide_levels(day: date, fresh_until: Optional[float]) -> pl.DataFrame:
+    """Read the tide levels on a given day from ``tide_cache``.
+
+    Out of date tide levels (``fresh_until`` is ``None``) are read again on
+    every call, so that they aren't used once NOAA is available again.
+    """
+    if fresh_until is None:
+        return pl.read_ipc_stream(tide_cache[_tide_cache_key(day)])
+    return _read_fresh_tide_levels(day, fresh_until)
+
+
+# Keep recently used days in memory to avoid reading them from the disk cache
+# on every call. Refreshed tide levels go out of date at a different time, so
+# they are read again. The returned frames must not be modified.
+@functools.lru_cache(maxsize=512)
+def _read_fresh_tide_levels(day: date, fresh_until: float) -> pl.DataFrame:
+    """Read up to date tide levels on a given day from ``tide_cache``."""
+    return _read_tide_levels(day, None)
+
+
+def _tide_cache_key(day: date) -> str:
+    """Get the key of the tide levels on a given day in ``tide_cache``."""
+    return f"tides-{day.isoformat()}"
+
+
+def _get_fresh_until(day: date) -> float:
+    """Get when the cached tide levels on a given day go out of date."""
+    fresh_until = _fresh_until.get(day, 0)
+    if fresh_until <= time.time():
+        # Another process may have fetched them again in the meantime
+        fresh_until = tide_cache.get(f"{_tide_cache_key(day)}:fresh_until", 0)
+        _fresh_until[day] = fresh_until
+    return fresh_until
+
+
+def _cache_tide_levels(day: date, df: pl.DataFrame) -> float:
+    """Store the tide levels on a given day in ``tide_cache``.
+
+    Frames are stored in the Arrow IPC format, which is much faster to read
+    back than a pickled frame. They are kept after going out of date so they
+    can be used as a fallback when the NOAA API is unavailable.
+
+    Returns when the stored tide levels go out of date.
+    """
+    key = _tide_cache_key(day)
+    fresh_until = time.time() + _tide_cache_ttl(day)
+    tide_cache.set(key, df.write_ipc_stream(None).getvalue(), tag="tide")
+    tide_cache.set(f"{key}:fresh_until", fresh_until, tag="tide")
+    _fresh_until[day] = fresh_until
+    return fresh_until
+
+
+def _tide_cache_ttl(day: date) -> float:
+    """Get how long the cached tide levels on a given day stay up to date.
+
+    Predictions for days well in the past never change, while those for days
+    far in the future are the most likely to be revised.
+    """
+    days_from_today = (day - date.today()).days
+    if days_from_today < -7:
+        return math.inf
+    if days_from_today <= 7:
+        return 86_400
+    return 3_600
+
+
+def _parse_tides(tides_resp: requests.Response) -> pl.DataFrame:
+    """Parse the tide levels from a NOAA API response."""
     if tides_resp.status_code != 200:
         raise ValueError(
             "Error getting tide information, status code: "
@@ -117,11 +309,167 @@ def get_tide_levels(day: date) -> pl.DataFrame:
     if tides_resp.get("error", None) is not None:
         raise ValueError(tides_resp["error"]["message"])
     df = pl.DataFrame(tides_resp["predictions"])
-    df = df.select(
+    return df.select(
         [
-            pl.col("t").str.to_datetime().alias("timestamp"),
+            # NOAA timestamps have a fixed format, so skip format inference
+            pl.col("t")
+            .str.strptime(pl.Datetime("us"), format="%Y-%m-%d %H:%M")
+            .alias("timestamp"),
             pl.col("v").cast(pl.Float64).alias("height_ft"),
         ]
     )
-    df = df.with_columns(is_light(df["timestamp"]))
-    return df
+
+
+def prefetch_tide_levels(
+    start: date, end: date
+) -> dict[date, Optional[float]]:
+    """Fetch the tide levels for a range of days in bulk.
+
+    The results are stored in the same cache as ``get_tide_levels``, so
+    subsequent calls for these days don't need to call the API. Days that are
+    already cached and up to date are not fetched again. Long ranges are split
+    into several requests, which are made concurrently.
+
+    Parameters
+    ----------
+    start : date
+        The first day to fetch.
+    end : date
+        The last day to fetch.
+
+    Returns
+    -------
+    dict[date, float or None]
+        When the cached tide levels on each day go out of date, as returned by
+        ``refresh_tide_levels``.
+    """
+    fresh_until = {
+        day: _get_fresh_until(day)
+        for day in pl.date_range(start, end, "1d", eager=True)
+    }
+    now = time.time()
+    stale_days = [day for day in fresh_until if fresh_until[day] <= now]
+    if not stale_days:
+        _use_tide_levels(fresh_until)
+        return fresh_until
+    # Request runs of consecutive stale days, up to the longest range the API
+    # returns in a single request
+    ranges = []
+    for day in stale_days:
+        if (
+            ranges
+            and (day - ranges[-1][-1]).days == 1
+            and len(ranges[-1]) < _MAX_DAYS_PER_REQUEST
+        ):
+            ranges[-1].append(day)
+        else:
+            ranges.append([day])
+
+    def fetch(days: list[date]) -> Optional[pl.DataFrame]:
+        # Out of date tide levels can be used instead, so only try once
+        # rather than waiting for retries
+        has_fallback = all(_tide_cache_key(day) in tide_cache for day in days)
+        get_tides = (
+            _get_tides_from_api.retry_with(stop=stop_after_attempt(1))
+            if has_fallback
+            else _get_tides_from_api
+        )
+        try:
+            return _parse_tides(get_tides(days[0], days[-1]))
+        except _FETCH_ERRORS:
+            if has_fallback:
+                return None
+            raise
+
+    with ThreadPoolExecutor(max_workers=_POOL_SIZE) as executor:
+        for days, df in zip(ranges, executor.map(fetch, ranges)):
+            if df is None:
+                fresh_until.update(dict.fromkeys(days))
+                continue
+            for (day,), daily_df in (
+                df.with_columns(
+                    is_light(df["timestamp"]),
+                    day=pl.col("timestamp").dt.date(),
+                )
+                .partition_by("day", as_dict=True, include_key=False)
+                .items()
+            ):
+                fresh_until[day] = _cache_tide_levels(day, daily_df)
+    _use_tide_levels(fresh_until)
+    return fresh_until
+
+
+def _use_tide_levels(fresh_until: dict[date, Optional[float]]) -> None:
+    """Record that tide levels were used for ``call_tracking_tide_levels``."""
+    used_fresh_until = _used_fresh_until.get()
+    if used_fresh_until is None:
+        return
+    if None in fresh_until.values():
+        _used_fresh_until.set(None)
+    else:
+        _used_fresh_until.set(min([used_fresh_until, *fresh_until.values()]))
+
+
+def get_tide_levels_range(start: datetime, end: datetime) -> pl.DataFrame:
+    """Get tide levels between two timestamps.
+
+    The values immediately before ``start`` and after ``end`` are also
+    included in case the timestamps don't line up perfectly with the
+    predictions.
+
+    Parameters
+    ----------
+    start : datetime
+        The first timestamp to consider (in local time).
+    end : datetime
+        The last timestamp to consider (in local time).
+
+    Returns
+    -------
+    DataFrame
+        Polars DataFrame with the same columns as ``get_tide_levels``.
+    """
+    fresh_until = prefetch_tide_levels(start=start.date(), end=end.date())
+    return (
+        pl.concat(
+            [
+                _read_tide_levels(day, day_fresh_until).lazy()
+                for day, day_fresh_until in fresh_until.items()
+            ],
+            rechunk=False,
+        )
+        .filter(
+            pl.col("timestamp").is_between(
+                start - timedelta(minutes=6),
+                end + timedelta(minutes=6),
+                closed="none",
+            )
+        )
+        .collect()
+    )
+
+
+def call_tracking_tide_levels(
+    func: Callable, *args, **kwargs
+) -> tuple[Any, Optional[float]]:
+    """Call a function and get when the tide levels it used go out of date.
+
+    Parameters
+    ----------
+    func : callable
+        The function to call with the remaining arguments.
+
+    Returns
+    -------
+    tuple
+        The result of ``func`` and when the tide levels it used go out of
+        date, as a Unix timestamp. The latter is ``math.inf`` if no tide
+        levels were used, and ``None`` if out of date tide levels were used
+        because the NOAA API couldn't be reached.
+    """
+    token = _used_fresh_until.set(math.inf)
+    try:
+        result = func(*args, **kwargs)
+        return result, _used_fresh_until.get()
+    finally:
+        _used_fresh_until.reset(token)
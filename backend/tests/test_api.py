@@ -30,6 +30,23 @@ def test_get_plot():
     assert resp.status_code == 200
     assert "data" in resp.json()
     assert "layout" in resp.json()
+    assert resp.headers["content-encoding"] == "gzip"
+    # Repeated request from a client with a cached copy
+    etag = resp.headers["etag"]
+    resp = client.get(
+        "/plot",
+        params={
+            "start_location": "Ozette Trailhead",
+            "end_location": "Norwegian Memorial",
+            "start_time": datetime(
+                year=2024, month=4, day=13, hour=8, minute=0
+            ),
+            "speed": 1.0,
+        },
+        headers={"If-None-Match": etag},
+    )
+    assert resp.status_code == 304
+    assert resp.headers["etag"] == etag
     # Invalid input
     resp = client.get(
         "/plot",
@@ -60,6 +77,18 @@ def test_get_routes():
     )
     df = pl.DataFrame(resp.json())
     assert len(df) == 9
+    # Repeated request from a client with a cached copy
+    resp = client.get(
+        "/routes",
+        params={
+            "section": "south",
+            "direction": "north",
+            "start_date": date(year=2024, month=4, day=13),
+            "end_date": date(year=2024, month=4, day=15),
+        },
+        headers={"If-None-Match": resp.headers["etag"]},
+    )
+    assert resp.status_code == 304
     # Too slow to be a valid route
     resp = client.get(
         "/routes",
@@ -87,6 +116,18 @@ def test_get_routes():
         "``min_daily_distance`` and ``max_daily_distance`` must both be "
         "positive"
     )
+    # Invalid input is rejected even for a client with a cached copy
+    resp = client.get(
+        "/routes",
+        params={
+            "section": "south",
+            "direction": "north",
+            "start_date": date(year=2024, month=4, day=15),
+            "end_date": date(year=2024, month=4, day=13),
+        },
+        headers={"If-None-Match": "*"},
+    )
+    assert resp.status_code == 400
 
 
 def test_get_locations():
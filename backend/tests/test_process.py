@@ -1,11 +1,15 @@
 """Unit tests for ``process`` module."""
 
 from datetime import date, datetime
+from typing import Optional
 
+import numpy as np
 import polars as pl
 import pytest
 
 from olympic_coast_treks.process import (
+    _analyze_leg,
+    _is_always_blocked,
     analyze_route_on_day,
     calc_possible_campsites,
     calc_routes,
@@ -195,6 +199,122 @@ def test_analyze_route_on_day():
     )
 
 
+# Tide predictions every 6 minutes during the day, and a restriction from
+# 0.8 to 1.2 hours into a leg at 1.5 miles per hour
+_LEG_TIMESTAMPS = pl.datetime_range(
+    datetime(year=2024, month=1, day=1, hour=6),
+    datetime(year=2024, month=1, day=1, hour=18),
+    "6m",
+    eager=True,
+)
+_LEG_RESTRICTIONS = {
+    "start_miles": np.array([8.9]),
+    "end_miles": np.array([9.5]),
+    "restriction_ft": np.array([3]),
+    "headland_alternative": np.array([False]),
+}
+
+
+def _analyze_test_leg(
+    heights: pl.Series,
+    keep: Optional[pl.Series] = None,
+    restrictions: dict[str, np.ndarray] = _LEG_RESTRICTIONS,
+    last_distance: float = 9.5,
+) -> list[tuple[datetime, datetime]]:
+    """Get the start time windows of a leg over the test tide levels."""
+    tides = pl.DataFrame({"timestamp": _LEG_TIMESTAMPS, "height_ft": heights})
+    if keep is not None:
+        tides = tides.filter(keep)
+    return (
+        _analyze_leg(
+            start_location="A",
+            end_location="B",
+            first_distance=7.7,
+            last_distance=last_distance,
+            day=date(year=2024, month=1, day=1),
+            tides=tides,
+            restrictions=restrictions,
+            speed=1.5,
+            min_buffer=1.0,
+        )
+        .select("first_possible_start", "last_possible_start")
+        .rows()
+    )
+
+
+def test_analyze_leg():
+    # The prediction at 7:00 is missing for the irregular spacing
+    irregular = _LEG_TIMESTAMPS != datetime(2024, 1, 1, 7)
+    all_day = [(datetime(2024, 1, 1, 6), datetime(2024, 1, 1, 16, 48))]
+    low = pl.Series([0.0] * len(_LEG_TIMESTAMPS))
+    high = pl.Series([10.0] * len(_LEG_TIMESTAMPS))
+    bypassable = {
+        **_LEG_RESTRICTIONS,
+        "headland_alternative": np.array([True]),
+    }
+    for keep in [None, irregular]:
+        # The tide is always below the restriction
+        assert _analyze_test_leg(low, keep) == all_day
+        # The restriction can always be bypassed
+        assert _analyze_test_leg(high, keep, bypassable) == all_day
+        # The tide is always above the restriction
+        assert _analyze_test_leg(high, keep) == []
+    # Traversing the restriction takes longer than the time between
+    # predictions, so a high tide blocks every start time
+    assert _is_always_blocked(
+        spacing=0.1,
+        heights=high.to_numpy(),
+        travel_hours=1.2,
+        start_travel_times=np.array([0.8]),
+        end_travel_times=np.array([1.2]),
+        restriction_fts=np.array([3]),
+        headland_alternatives=np.array([False]),
+        min_buffer=1.0,
+    )
+    # Otherwise there may be a start time when the hike is between predictions
+    # along the whole restriction
+    assert not _is_always_blocked(
+        spacing=0.5,
+        heights=high.to_numpy(),
+        travel_hours=1.2,
+        start_travel_times=np.array([0.8]),
+        end_travel_times=np.array([1.2]),
+        restriction_fts=np.array([3]),
+        headland_alternatives=np.array([False]),
+        min_buffer=1.0,
+    )
+    # The tide is only high from 9:00 to 10:00, which blocks start times from
+    # 7:48 to 9:12 whichever way the predictions are spaced
+    heights = 10.0 * _LEG_TIMESTAMPS.is_between(
+        datetime(2024, 1, 1, 9), datetime(2024, 1, 1, 10)
+    )
+    for keep in [None, irregular]:
+        assert _analyze_test_leg(heights, keep) == [
+            (datetime(2024, 1, 1, 6), datetime(2024, 1, 1, 7, 42)),
+            (datetime(2024, 1, 1, 9, 18), datetime(2024, 1, 1, 16, 48)),
+        ]
+
+
+def test_analyze_leg_restriction_edges():
+    # The tide is only high at noon, which is exactly 0.8 hours after 11:12
+    # and 1.2 hours after 10:48. Those start times are blocked even though
+    # (8.9 - 7.7) / 1.5 is slightly more than 0.8.
+    heights = 10.0 * (_LEG_TIMESTAMPS == datetime(2024, 1, 1, 12))
+    # The prediction at 7:00 is missing for the irregular spacing
+    irregular = _LEG_TIMESTAMPS != datetime(2024, 1, 1, 7)
+    for keep in [None, irregular]:
+        assert _analyze_test_leg(heights, keep) == [
+            (datetime(2024, 1, 1, 6), datetime(2024, 1, 1, 10, 42)),
+            (datetime(2024, 1, 1, 11, 18), datetime(2024, 1, 1, 16, 48)),
+        ]
+    # Noon is exactly where the restriction ends 1.2 hours after 10:48
+    for keep in [None, irregular]:
+        assert _analyze_test_leg(heights, keep, last_distance=10.1) == [
+            (datetime(2024, 1, 1, 6), datetime(2024, 1, 1, 10, 42)),
+            (datetime(2024, 1, 1, 11, 18), datetime(2024, 1, 1, 16, 24)),
+        ]
+
+
 def test_calc_routes():
     with pytest.raises(ValueError):
         res = calc_routes(
@@ -218,6 +338,29 @@ def test_calc_routes():
             min_daily_distance=3,
             max_daily_distance=10,
         )
+    with pytest.raises(ValueError):
+        res = calc_routes(
+            start_date=date(year=2024, month=4, day=13),
+            end_date=date(year=2024, month=4, day=15),
+            section="north",
+            direction="north",
+            speed=1.0,
+            min_buffer=0.0,
+            min_daily_distance=10,
+            max_daily_distance=3,
+        )
+    # Two days of at most 5 miles can't cover the north section
+    res = calc_routes(
+        start_date=date(year=2024, month=4, day=13),
+        end_date=date(year=2024, month=4, day=14),
+        section="north",
+        direction="north",
+        speed=1.0,
+        min_buffer=0.0,
+        min_daily_distance=3,
+        max_daily_distance=5,
+    )
+    assert res.is_empty()
     # This is a route I've done, so I know it works
     res = calc_routes(
         start_date=date(year=2024, month=4, day=13),
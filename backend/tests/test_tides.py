@@ -1,29 +1,45 @@
 """Unit tests for ``tides`` module."""
 
-from datetime import date
+import math
+from datetime import date, datetime, timedelta
 
 import polars as pl
 import pytest
+import requests
 from numpy.testing import assert_almost_equal
 
-from olympic_coast_treks.tides import get_tide_levels, is_light
+from olympic_coast_treks.tides import (
+    _REQUEST_TIMEOUT,
+    _cache_tide_levels,
+    _fresh_until,
+    _session,
+    _tide_cache_key,
+    _tide_cache_ttl,
+    get_daylight_bounds,
+    get_light_tide_levels,
+    get_tide_levels,
+    get_tide_levels_range,
+    is_light,
+    prefetch_tide_levels,
+    tide_cache,
+)
 
 
 def test_is_light():
     ts = pl.Series("ts", [], dtype=pl.Datetime)
     light_times = is_light(ts)
     assert light_times.is_empty()
+    # Sunrise and sunset are determined separately for each day
     ts = pl.Series(
         "ts",
         [
             "2024-01-15 08:03:00",
-            "2024-01-16 08:04:00",
-            "2024-01-16 08:05:00",
+            "2024-01-16 08:03:00",
+            "2024-01-16 16:53:30",
         ],
     ).str.to_datetime()
-    # Function requires all timestamps to be on the same day
-    with pytest.raises(ValueError):
-        is_light(ts)
+    light_times = is_light(ts)
+    assert light_times.equals(pl.Series([False, True, True]))
     ts = pl.Series(
         "ts",
         [
@@ -36,6 +52,15 @@ def test_is_light():
     assert light_times.equals(pl.Series([False, True, True]))
 
 
+def test_get_daylight_bounds():
+    sunrise, sunset = get_daylight_bounds(date(year=2024, month=1, day=15))
+    assert sunrise.date() == sunset.date() == date(year=2024, month=1, day=15)
+    assert sunrise.tzinfo is None
+    assert sunset.tzinfo is None
+    assert sunrise < sunset
+    assert is_light(pl.Series([sunrise, sunset])).all()
+
+
 def test_get_tide_levels():
     levels = get_tide_levels(date(year=2025, month=3, day=1))
     assert len(levels) == 240
@@ -47,3 +72,132 @@ def test_get_tide_levels():
     assert_almost_equal(levels["height_ft"].mean(), 4.82895, decimal=5)
     with pytest.raises(ValueError):
         get_tide_levels(date(year=3000, month=3, day=1))
+
+
+def test_get_tide_levels_stale():
+    # Out of date tide levels are used when they can't be fetched again
+    day = date(year=3000, month=1, day=1)
+    key = _tide_cache_key(day)
+    stale = pl.DataFrame(
+        {
+            "timestamp": [datetime(year=3000, month=1, day=1)],
+            "height_ft": [1.0],
+            "is_light": [False],
+        }
+    )
+    _cache_tide_levels(day, stale)
+    tide_cache.set(f"{key}:fresh_until", 0)
+    _fresh_until.pop(day)
+    try:
+        assert get_tide_levels(day).equals(stale)
+        assert prefetch_tide_levels(start=day, end=day) == {day: None}
+        # Out of date tide levels aren't kept in memory
+        stale = stale.with_columns(height_ft=pl.lit(2.0))
+        tide_cache.set(key, stale.write_ipc_stream(None).getvalue())
+        assert get_tide_levels(day).equals(stale)
+    finally:
+        tide_cache.delete(key)
+        tide_cache.delete(f"{key}:fresh_until")
+        _fresh_until.pop(day, None)
+
+
+def test_get_tide_levels_unavailable(monkeypatch):
+    # Out of date tide levels are used after a single attempt to fetch them,
+    # which times out rather than hanging
+    calls = []
+
+    def get(*args, **kwargs):
+        calls.append(kwargs)
+        raise requests.ConnectionError
+
+    monkeypatch.setattr(_session, "get", get)
+    day = date(year=3000, month=1, day=3)
+    key = _tide_cache_key(day)
+    stale = pl.DataFrame(
+        {
+            "timestamp": [datetime(year=3000, month=1, day=3)],
+            "height_ft": [1.0],
+            "is_light": [False],
+        }
+    )
+    _cache_tide_levels(day, stale)
+    tide_cache.set(f"{key}:fresh_until", 0)
+    _fresh_until.pop(day)
+    try:
+        assert get_tide_levels(day).equals(stale)
+        assert len(calls) == 1
+        assert calls[0]["timeout"] == _REQUEST_TIMEOUT
+    finally:
+        tide_cache.delete(key)
+        tide_cache.delete(f"{key}:fresh_until")
+        _fresh_until.pop(day, None)
+
+
+def test_get_tide_levels_refreshed():
+    # Tide levels held in memory are replaced once they are refreshed
+    day = date(year=3000, month=1, day=2)
+    key = _tide_cache_key(day)
+    try:
+        for height_ft in [1.0, 2.0]:
+            levels = pl.DataFrame(
+                {
+                    "timestamp": [datetime(year=3000, month=1, day=2)],
+                    "height_ft": [height_ft],
+                    "is_light": [False],
+                }
+            )
+            _cache_tide_levels(day, levels)
+            assert get_tide_levels(day).equals(levels)
+    finally:
+        tide_cache.delete(key)
+        tide_cache.delete(f"{key}:fresh_until")
+        _fresh_until.pop(day, None)
+
+
+def test_tide_cache_ttl():
+    today = date.today()
+    assert _tide_cache_ttl(today - timedelta(days=30)) == math.inf
+    assert _tide_cache_ttl(today - timedelta(days=7)) == 86_400
+    assert _tide_cache_ttl(today) == 86_400
+    assert _tide_cache_ttl(today + timedelta(days=7)) == 86_400
+    assert _tide_cache_ttl(today + timedelta(days=30)) == 3_600
+
+
+def test_get_light_tide_levels():
+    levels = get_light_tide_levels(date(year=2025, month=3, day=1))
+    assert levels.columns == ["timestamp", "height_ft"]
+    assert levels.equals(
+        get_tide_levels(date(year=2025, month=3, day=1))
+        .filter(pl.col("is_light"))
+        .drop("is_light")
+    )
+
+
+def test_get_tide_levels_range():
+    levels = get_tide_levels_range(
+        start=datetime(year=2025, month=3, day=1, hour=22, minute=3),
+        end=datetime(year=2025, month=3, day=2, hour=1, minute=57),
+    )
+    assert levels.columns == ["timestamp", "height_ft", "is_light"]
+    # Includes the adjacent values on either side of the window
+    assert len(levels) == 41
+    assert levels["timestamp"].is_sorted()
+    assert levels["timestamp"][0] == datetime(2025, 3, 1, 22, 0)
+    assert levels["timestamp"][-1] == datetime(2025, 3, 2, 2, 0)
+
+
+def test_prefetch_tide_levels():
+    prefetch_tide_levels(
+        start=date(year=2025, month=4, day=1),
+        end=date(year=2025, month=4, day=3),
+    )
+    for day in [1, 2, 3]:
+        levels = get_tide_levels(date(year=2025, month=4, day=day))
+        assert len(levels) == 240
+        assert levels.columns == ["timestamp", "height_ft", "is_light"]
+        assert (levels["timestamp"].dt.day() == day).all()
+    with pytest.raises(ValueError):
+        prefetch_tide_levels(
+            start=date(year=3000, month=3, day=1),
+            end=date(year=3000, month=3, day=2),
+        )